@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 
 import capnp
+import contextlib
+import hashlib
+from itertools import chain
+import os
+import pickle
 import sys
+import tempfile
+from typing import Any, Iterator, Literal, Union
 
 SPEC_FILE = 'test/trangequery.capnp'
 CAPNP_BASIC_TYPES = {
@@ -21,18 +28,62 @@ CAPNP_BASIC_TYPES = {
     'data': 'std::string',
 }
 BASE_NAMESPACE = 'NKikimrCapnProto_'
+CACHE_ENV = 'CAPNP_WRAPPER_GEN_CACHE' # set to 1 to cache parsed schemas on disk
+CACHE_VERSION = 3 # bump whenever the layout of the cached Parser state changes
+
+# Per-field method templates, bound to str.format once at import time.
+_USING_TMPL = "using {ns}::{struct}::Builder::get{name};".format
+_BASIC_HAS_TMPL = "bool Has{name}() const {{ return get{name}() != 0; }}".format
+_STRUCT_HAS_TMPL = "bool Has{name}() const {{ return has{name}(); }}".format
+_ENUM_HAS_TMPL = "bool Has{name}() const {{ return get{name}() != {ns}::{type_}::NOT_SET; }}".format
+_BASIC_GET_TMPL = "{type_} Get{name}() const {{ return get{name}(); }}".format
+_STRUCT_GET_TMPL = "{type_}::Reader Get{name}() const {{ return get{name}(); }}".format
+_ENUM_GET_TMPL = "{type_} Get{name}() const {{ return static_cast<{type_}>(static_cast<size_t>(get{name}()) - 1); }}".format
+_BASIC_SET_TMPL = "void Set{name}(const {type_}& value) {{ return set{name}(value); }}".format
+_STRUCT_SET_TMPL = "void Set{name}(const {type_}::Reader& value) {{ return set{name}(value.GetCapnpBase()); }}".format
+_ENUM_SET_TMPL = "void Set{name}(const {type_}& value) {{ return set{name}(static_cast<{ns}::{type_}>(static_cast<size_t>(value) + 1)); }}".format
+_MUTABLE_TMPL = "{type_}::Builder Mutable{name}() {{ return get{name}(); }}".format
+
+# Per-node templates, filled once per struct / enum.
+_STRUCT_TMPL = """
+struct {name} {{
+    struct Reader : private {ns}::{name}::Reader {{
+    public:
+        {reader}
+    }};
+    
+    struct Builder : private {ns}::{name}::Builder, public Reader {{
+    private:
+        {usings}
+    public:
+        {builder}
+    }};
+}};
+            """.format
+_ENUM_TMPL = """
+enum class {name} {{
+    {enumerants},
+}};
+            """.format
+
+Fields = dict[str, str] # field name -> field type
+Node = Union[tuple[Literal['struct'], Fields], tuple[Literal['enum'], list[str]]]
+Partition = tuple[list[tuple[str, str]], list[tuple[str, str]], list[tuple[str, str]]]
 
-def cap(s):
-    return s[0].upper() + s[1:]
+def cap(s: str) -> str:
+    return s[:1].upper() + s[1:]
 
-def low(s):
-    return s[0].lower() + s[1:]
+def low(s: str) -> str:
+    return s[:1].lower() + s[1:]
 
 class Parser:
-    def __init__(self):
-        self.struct_ids = {} # struct id -> struct name
-        self.enum_ids = {} # enum id -> enum name
-        self.nodes = {} # node name -> ((field name -> field type) | enumerants)
+    def __init__(self, use_cache: bool = False) -> None:
+        # The cache is keyed on the root schema file only: edits to files it imports are not noticed.
+        self.use_cache = use_cache
+        self.struct_ids: dict[int, str] = {} # struct id -> struct name
+        self.enum_ids: dict[int, str] = {} # enum id -> enum name
+        self.modules: dict[str, Any] = {} # node name -> schema module, filled by index() (left empty on a cache hit)
+        self.nodes: dict[str, Node] = {} # node name -> (('struct', field name -> field type) | ('enum', enumerants)), filled by resolve()
 
     @staticmethod
     def get_struct_id(struct) -> int:
@@ -42,179 +93,221 @@ class Parser:
     def get_enum_id(enum) -> int:
         return enum.schema.node.id
 
-    def get_list_type(self, list_) -> int:
-        if list_.proto.slot.type.list.elementType._which_str() == 'struct':
-            return self.struct_ids[list_.proto.slot.type.list.elementType.struct.typeId]
-        return list_.proto.slot.type.list.elementType._which_str()
-
-    def parse_struct(self, fields):
-        res = {} # field name -> field type
+    def get_list_type(self, slot_type) -> str:
+        elem = slot_type.list.elementType
+        which = elem._which_str()
+        if which == 'struct':
+            return self.struct_ids[elem.struct.typeId]
+        return which
+
+    def parse_struct(self, fields) -> Fields:
+        resolvers = {
+            'struct': lambda slot_type: self.struct_ids[slot_type.struct.typeId],
+            'enum': lambda slot_type: self.enum_ids[slot_type.enum.typeId],
+            'list': lambda slot_type: f'List({self.get_list_type(slot_type)})',
+        }
+        res: Fields = {} # field name -> field type
         for name, field in fields.items():
-            type_ =  field.proto.slot.type.which()
-            if type_ == 'struct':
-                type_ = self.struct_ids[self.get_struct_id(field)]
-            elif type_ == 'enum':
-                type_ = self.enum_ids[self.get_enum_id(field)]
-            elif type_ == 'list':
-                type_ = f'List({self.get_list_type(field)})'
-            res[cap(name)] = type_
+            slot_type = field.proto.slot.type
+            type_ = slot_type.which()
+            resolve = resolvers.get(type_)
+            res[cap(name)] = type_ if resolve is None else resolve(slot_type)
 
         return res
 
-    def parse(self, file_path: str):
+    def index(self, file_path: str) -> list[str]:
         schema = capnp.load(file_path)
         for name, module in schema.__dict__.items():
             if isinstance(module, capnp.lib.capnp._StructModule):
                 self.struct_ids[self.get_struct_id(module)] = name
-                self.nodes[name] = self.parse_struct(module.schema.fields)
-            if isinstance(module, capnp.lib.capnp._EnumModule):
+                self.modules[name] = module
+            elif isinstance(module, capnp.lib.capnp._EnumModule):
                 self.enum_ids[self.get_enum_id(module)] = name
-                self.nodes[name] = [cap(enumerant) for enumerant in module.schema.enumerants.keys()][1:]
-        return self.nodes
+                self.modules[name] = module
+        return list(self.modules)
 
+    def resolve(self, name: str) -> Node:
+        if name not in self.nodes:
+            module = self.modules[name]
+            if isinstance(module, capnp.lib.capnp._StructModule):
+                self.nodes[name] = ('struct', self.parse_struct(module.schema.fields))
+            else:
+                self.nodes[name] = ('enum', [cap(enumerant) for enumerant in module.schema.enumerants.keys()][1:])
+        return self.nodes[name]
 
-class Generator:
-    def __init__(self, nodes):
-        self.nodes = nodes
-        self.enum_names = [node for node, content in self.nodes.items() if type(content) is list]
-        self.struct_names = [node for node, content in self.nodes.items() if type(content) is dict]
+    @staticmethod
+    def get_cache_dir() -> str:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'capnp-wrapper-gen')
 
-    def is_enum(self, node):
-        return node in self.nodes and type(self.nodes[node]) is list
+    @staticmethod
+    def get_cache_path(file_path: str) -> str:
+        stat = os.stat(file_path)
+        key = f'{CACHE_VERSION}:{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}'
+        return os.path.join(Parser.get_cache_dir(), hashlib.sha256(key.encode()).hexdigest() + '.pkl')
+
+    def parse(self, file_path: str) -> dict[str, Node]:
+        if not self.use_cache:
+            for name in self.index(file_path):
+                self.resolve(name)
+            return self.nodes
+
+        cache_path = self.get_cache_path(file_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                self.struct_ids, self.enum_ids, self.nodes = pickle.load(f)
+            return self.nodes
+        except Exception:
+            # missing, truncated or foreign cache file: fall back to a normal parse
+            pass
+
+        for name in self.index(file_path):
+            self.resolve(name)
+
+        tmp_path = None
+        try:
+            cache_dir = os.path.dirname(cache_path)
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=cache_dir, suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                pickle.dump((self.struct_ids, self.enum_ids, self.nodes), f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+        return self.nodes
 
-    def is_struct(self, node):
-        return node in self.nodes and type(self.nodes[node]) is dict
 
-    def is_basic_type(self, node):
-        return node in CAPNP_BASIC_TYPES
+class Generator:
+    def __init__(self, nodes: dict[str, Node]) -> None:
+        self.nodes = nodes
+        self._enum_set = frozenset(node for node, (tag, _) in nodes.items() if tag == 'enum')
+        self._struct_set = frozenset(node for node, (tag, _) in nodes.items() if tag == 'struct')
+        self._partitions: dict[str, Partition] = {} # struct name -> (basic fields, struct fields, enum fields), see _partition()
 
     @staticmethod
-    def generate_reader_constructors(name):
+    def generate_reader_constructors(name: str) -> list[str]:
         return [f"Reader({BASE_NAMESPACE}::{name}::Reader r) : {BASE_NAMESPACE}::{name}::Reader(r) {{}}", "Reader() = default;"]
 
     @staticmethod
-    def generate_builder_constructors(name):
+    def generate_builder_constructors(name: str) -> list[str]:
         return [f"Builder({BASE_NAMESPACE}::{name}::Builder b) : {BASE_NAMESPACE}::{name}::Builder(b), Reader(b.asReader()) {{}}"]
 
     @staticmethod
-    def generate_builder_operators():
+    def generate_builder_operators() -> list[str]:
         return [
             "Builder* operator->() { return this; }",
             "Builder& operator*() { return *this; }",
         ]
 
     @staticmethod
-    def generate_capnp_base_reader_method(name):
+    def generate_capnp_base_reader_method(name: str) -> str:
         return f"const {BASE_NAMESPACE}::{name}::Reader& GetCapnpBase() const {{ return *this; }}"
 
     @staticmethod
-    def generate_capnp_base_builder_method(name):
+    def generate_capnp_base_builder_method(name: str) -> str:
         return f"const {BASE_NAMESPACE}::{name}::Builder& GetCapnpBase() const {{ return *this; }}"
 
-    def generate_using_builder_methods(self, name, fields):
+    def _partition(self, struct_name: str, fields: Fields) -> Partition:
+        if struct_name not in self._partitions:
+            basic_types, struct_set, enum_set = CAPNP_BASIC_TYPES, self._struct_set, self._enum_set
+            basics, structs, enums = [], [], [] # (field name, C++ type for basics / node name otherwise)
+            for name, type_ in fields.items():
+                cpp_type = basic_types.get(type_)
+                if cpp_type is not None:
+                    basics.append((name, cpp_type))
+                elif type_ in struct_set:
+                    structs.append((name, type_))
+                elif type_ in enum_set:
+                    enums.append((name, type_))
+                # List(...), interface and anyPointer fields get no wrapper methods
+            self._partitions[struct_name] = (basics, structs, enums)
+        return self._partitions[struct_name]
+
+    def generate_using_builder_methods(self, name: str, fields: Fields) -> str:
         sep = '\n' + 8 * ' '
-        usings = [f"using {BASE_NAMESPACE}::{name}::Builder::get{field};" for field, type_ in fields.items() if self.is_struct(type_)]
+        _, structs, _ = self._partition(name, fields)
+        ns = BASE_NAMESPACE
+        usings = [_USING_TMPL(ns=ns, struct=name, name=field) for field, type_ in structs]
         return sep.join(usings)
 
-    def generate_has_methods(self, struct_name):
-        struct = [f"bool Has{name}() const {{ return has{name}(); }}" for name, type_ in self.nodes[struct_name].items() if self.is_struct(type_)]
-        enum = [f"bool Has{name}() const {{ return get{name}() != {BASE_NAMESPACE}::{type_}::NOT_SET; }}" for name, type_ in self.nodes[struct_name].items() if self.is_enum(type_)]
-        basic = [f"bool Has{name}() const {{ return get{name}() != 0; }}" for name, type_ in self.nodes[struct_name].items() if self.is_basic_type(type_)]
+    def generate_has_methods(self, struct_name: str, fields: Fields) -> list[str]:
+        basics, structs, enums = self._partition(struct_name, fields)
+        ns = BASE_NAMESPACE
+        struct = [_STRUCT_HAS_TMPL(name=name) for name, type_ in structs]
+        enum = [_ENUM_HAS_TMPL(name=name, type_=type_, ns=ns) for name, type_ in enums]
+        basic = [_BASIC_HAS_TMPL(name=name) for name, type_ in basics]
         return struct + enum + basic
 
-    def generate_get_methods(self, struct_name):
-        fields = self.nodes[struct_name].items()
-
-        template = "{type_} Get{name}() const {{ return get{name}(); }}"
-        basic = [template.format(name=name, type_=CAPNP_BASIC_TYPES[type_]) for name, type_ in fields if self.is_basic_type(type_)]
-        struct = [template.format(name=name, type_=f"{type_}::Reader") for name, type_ in fields if self.is_struct(type_)]
-
-        enum_template = "{type_} Get{name}() const {{ return static_cast<{type_}>(static_cast<size_t>(get{name}()) - 1); }}"
-        enum = [enum_template.format(name=name, type_=type_) for name, type_ in fields if self.is_enum(type_)]
-
+    def generate_get_methods(self, struct_name: str, fields: Fields) -> list[str]:
+        basics, structs, enums = self._partition(struct_name, fields)
+        basic = [_BASIC_GET_TMPL(name=name, type_=type_) for name, type_ in basics]
+        struct = [_STRUCT_GET_TMPL(name=name, type_=type_) for name, type_ in structs]
+        enum = [_ENUM_GET_TMPL(name=name, type_=type_) for name, type_ in enums]
         return basic + struct + enum
 
-    def generate_set_methods(self, struct_name):
-        fields = self.nodes[struct_name].items()
-
-        basic_template = "void Set{name}(const {type_}& value) {{ return set{name}(value); }}"
-        basic = [basic_template.format(name=name, type_=CAPNP_BASIC_TYPES[type_]) for name, type_ in fields if self.is_basic_type(type_)]
-
-        struct_template = "void Set{name}(const {type_}::Reader& value) {{ return set{name}(value.GetCapnpBase()); }}"
-        struct = [struct_template.format(name=name, type_=type_) for name, type_ in fields if self.is_struct(type_)]
-
-        enum_template = "void Set{name}(const {type_}& value) {{ return set{name}(static_cast<{base_ns}::{type_}>(static_cast<size_t>(value) + 1)); }}"
-        enum = [enum_template.format(name=name, type_=type_, base_ns=BASE_NAMESPACE) for name, type_ in fields if self.is_enum(type_)]
-
+    def generate_set_methods(self, struct_name: str, fields: Fields) -> list[str]:
+        basics, structs, enums = self._partition(struct_name, fields)
+        ns = BASE_NAMESPACE
+        basic = [_BASIC_SET_TMPL(name=name, type_=type_) for name, type_ in basics]
+        struct = [_STRUCT_SET_TMPL(name=name, type_=type_) for name, type_ in structs]
+        enum = [_ENUM_SET_TMPL(name=name, type_=type_, ns=ns) for name, type_ in enums]
         return basic + struct + enum
 
-    def generate_mutable_methods(self, struct_name):
-        return [f"{type_}::Builder Mutable{name}() {{ return get{name}(); }}" for name, type_ in self.nodes[struct_name].items() if self.is_struct(type_)]
+    def generate_mutable_methods(self, struct_name: str, fields: Fields) -> list[str]:
+        _, structs, _ = self._partition(struct_name, fields)
+        return [_MUTABLE_TMPL(name=name, type_=type_) for name, type_ in structs]
 
-    def generate_reader(self, name, fields):
+    def generate_reader(self, name: str, fields: Fields) -> str:
         sep = '\n' + 8 * ' '
-        methods = self.generate_reader_constructors(name) + \
-                  self.generate_get_methods(name) + \
-                  self.generate_has_methods(name) + \
-                  [self.generate_capnp_base_reader_method(name)]
-        return sep.join(methods)
-
-    def generate_builder(self, name, fields):
+        return sep.join(chain(
+            self.generate_reader_constructors(name),
+            self.generate_get_methods(name, fields),
+            self.generate_has_methods(name, fields),
+            (self.generate_capnp_base_reader_method(name),),
+        ))
+
+    def generate_builder(self, name: str, fields: Fields) -> str:
         sep = '\n' + 8 * ' '
-        methods = self.generate_builder_constructors(name) + \
-                  self.generate_builder_operators() + \
-                  self.generate_set_methods(name) + \
-                  self.generate_mutable_methods(name) + \
-                  [self.generate_capnp_base_builder_method(name)]
-        return sep.join(methods)
-
-    def generate_struct(self, name, fields):
-        code = \
-            f"""
-struct {name} {{
-    struct Reader : private {BASE_NAMESPACE}::{name}::Reader {{
-    public:
-        {self.generate_reader(name, fields)}
-    }};
-    
-    struct Builder : private {BASE_NAMESPACE}::{name}::Builder, public Reader {{
-    private:
-        {self.generate_using_builder_methods(name, fields)}
-    public:
-        {self.generate_builder(name, fields)}
-    }};
-}};
-            """
-        return code
-
-    def generate_enum(self, name, enumerants):
+        return sep.join(chain(
+            self.generate_builder_constructors(name),
+            self.generate_builder_operators(),
+            self.generate_set_methods(name, fields),
+            self.generate_mutable_methods(name, fields),
+            (self.generate_capnp_base_builder_method(name),),
+        ))
+
+    def generate_struct(self, name: str, fields: Fields) -> str:
+        return _STRUCT_TMPL(
+            name=name,
+            ns=BASE_NAMESPACE,
+            reader=self.generate_reader(name, fields),
+            usings=self.generate_using_builder_methods(name, fields),
+            builder=self.generate_builder(name, fields),
+        )
+
+    def generate_enum(self, name: str, enumerants: list[str]) -> str:
         sep = ',\n' + 4 * ' '
-        code = \
-            f"""
-enum class {name} {{
-    {sep.join(enumerants)},
-}};
-            """
-        return code
-
-    def generate(self, nodes):
-        res = ""
-        for node, content in nodes.items():
-            if type(content) is list:
-                res += self.generate_enum(node, content)
-            else:
-                res += self.generate_struct(node, content)
+        return _ENUM_TMPL(name=name, enumerants=sep.join(enumerants))
 
-        return res
+    def generate(self, nodes: dict[str, Node]) -> Iterator[str]:
+        for name, node in nodes.items():
+            if node[0] == 'enum':
+                yield self.generate_enum(name, node[1])
+            else:
+                yield self.generate_struct(name, node[1])
 
 
-def main():
-    p = Parser()
+def main() -> None:
+    p = Parser(use_cache=os.environ.get(CACHE_ENV) == '1')
     nodes = p.parse(SPEC_FILE if len(sys.argv) < 2 else sys.argv[1])
 
     g = Generator(nodes)
-    text = g.generate(nodes)
-    print(text)
+    write = sys.stdout.write
+    for chunk in g.generate(nodes):
+        write(chunk)
+    write('\n')
 
     # try:
     #     os.remove(GENERATED_STRUCTS_FILE)